@@ -1,12 +1,109 @@
+import weakref
+
 import cobra
 from cobra import Reaction
 from cobra.flux_analysis.loopless import loopless_solution
 from cobra.flux_analysis import flux_variability_analysis
+from cobra.util import ProcessPool
+from optlang.interface import OPTIMAL
 import numpy as np
 import pandas as pd
 
+# Fraction of the maximal growth that is enforced during flux variability analysis
+_FVA_FRACTION_OF_OPTIMUM = 0.95
+
+
+def _init_worker(fvseof):
+    """
+    Initialize a worker process for the step flux calculations or the essentiality checks.
+
+    Parameters
+    ----------
+    fvseof : FVSEOF
+        The FVSEOF instance whose model is used in the worker.
+    """
+    global _fvseof
+    _fvseof = fvseof
+    _fvseof.model.objective = _fvseof.biomass_reaction_id
+
+
+def _check_essential_reaction_worker(target):
+    """
+    Check if a reaction is essential in a worker process.
+
+    Parameters
+    ----------
+    target : tuple
+        The position of the reaction among the targets and the id of the reaction to check.
+
+    Returns
+    -------
+    result : tuple
+        The position of the reaction among the targets and whether the reaction is essential or not.
+    """
+    position, reaction_id = target
+    return position, _fvseof._check_essential_reaction(reaction_id)
+
+
+def _step_fluxes_worker(step):
+    """
+    Calculate the flux ranges for a single step in a worker process.
+
+    Parameters
+    ----------
+    step : tuple
+        The index of the step, the lower bound on target production for the step and whether to perform flux variability analysis.
+
+    Returns
+    -------
+    result : tuple
+        The index of the step and the minimal and maximal fluxes of all reactions for the step.
+    """
+    i, step_lower_bound, fva = step
+    reaction_ids = _fvseof.model.reactions.list_attr("id")
+    return i, _fvseof._calc_step_fluxes(step_lower_bound, reaction_ids, fva=fva)
+
+
+def _classify_and_slope(fluxes, steps_lower_bounds):
+    """
+    Assign target types and find the slopes of linear regressions for all reactions at once.
+
+    Parameters
+    ----------
+    fluxes : np.ndarray
+        The (mean) fluxes of all reactions (rows) for each step (columns).
+    steps_lower_bounds : list
+        The lower bound on target production for each step.
+
+    Returns
+    -------
+    target_types : np.ndarray
+        The target type ("Up", "Down" or "Reverse") of each reaction, or an empty string if the reaction is not a target.
+    slopes : np.ndarray
+        The slope of the linear regression of the fluxes of each reaction on the lower bounds.
+    """
+    first_fluxes, last_fluxes = fluxes[:, 0], fluxes[:, -1]
+    changed = first_fluxes != last_fluxes
+    same_sign = changed & (first_fluxes * last_fluxes >= 0)
+    increased = np.abs(last_fluxes) > np.abs(first_fluxes)
+    target_types = np.full(len(fluxes), "", dtype=object)
+    target_types[same_sign & increased] = "Up"
+    target_types[same_sign & ~increased] = "Down"
+    target_types[changed & (first_fluxes * last_fluxes < 0)] = "Reverse"
+
+    # Closed-form least squares solution of a degree 1 fit
+    centered_lower_bounds = np.asarray(steps_lower_bounds, dtype=np.float64)
+    centered_lower_bounds -= centered_lower_bounds.mean()
+    slopes = (fluxes - fluxes.mean(axis=1, keepdims=True)) @ centered_lower_bounds / (centered_lower_bounds @ centered_lower_bounds)
+
+    return target_types, slopes
+
+
 class FVSEOF():
-    def __init__(self, model, biomass_reaction_id, target_metabolite_id, essential_reaction_threshold = 0.5):
+    # Maximal theoretical yield and maximal growth per model, keyed by biomass reaction id, target metabolite id and reaction bounds
+    _yield_and_growth_cache = weakref.WeakKeyDictionary()
+
+    def __init__(self, model, biomass_reaction_id, target_metabolite_id, essential_reaction_threshold = 0.5, use_cache = False):
         """
         Initialize the FVSEOF class.
 
@@ -20,6 +117,9 @@ class FVSEOF():
             The id of the metabolite to perform FVSEOF on.
         essential_reaction_threshold : float, optional
             The threshold fraction of max biomass production below which knocked out reactions are considered essential. The default is 0.5.
+        use_cache : bool, optional
+            Whether to reuse the maximal theoretical yield and maximal growth calculated by an earlier instance for the same model, biomass reaction, target metabolite and reaction bounds.
+            Changes to the model other than reaction bounds (e.g. added reactions or changed stoichiometry) are not detected, call FVSEOF.clear_cache() after those. The default is False.
         """
         self.model = model
         self.biomass_reaction_id = biomass_reaction_id
@@ -28,11 +128,26 @@ class FVSEOF():
         assert self.target_metabolite_id in [m.id for m in self.model.metabolites], "Target metabolite not in model."
 
         self.product_sink_reaction_id = self.add_product_sink_reaction(self.target_metabolite_id)
-        self.product_max_theoretical_yield = self.calc_product_maximal_theoretical_yield()
-        self.maximal_biomass_growth = self.calc_maximal_biomass_growth()
+
+        if use_cache:
+            model_cache = FVSEOF._yield_and_growth_cache.setdefault(self.model, {})
+            cache_key = (self.biomass_reaction_id, self.target_metabolite_id, tuple(self.model.reactions.list_attr("bounds")))
+            if cache_key not in model_cache:
+                model_cache[cache_key] = (self.calc_product_maximal_theoretical_yield(), self.calc_maximal_biomass_growth())
+            self.product_max_theoretical_yield, self.maximal_biomass_growth = model_cache[cache_key]
+        else:
+            self.product_max_theoretical_yield = self.calc_product_maximal_theoretical_yield()
+            self.maximal_biomass_growth = self.calc_maximal_biomass_growth()
 
         self.check_essential_reaction_threshold = essential_reaction_threshold
 
+    @classmethod
+    def clear_cache(cls):
+        """
+        Clear the cached maximal theoretical yields and maximal growths of all models.
+        """
+        cls._yield_and_growth_cache.clear()
+
     def add_product_sink_reaction(self, target_metabolite_id):
         """
         Add a sink reaction for the target metabolite to the model.
@@ -73,10 +188,13 @@ class FVSEOF():
             The maximal theoretical yield of the target metabolite.
 
         """
-        with self.model as model:
-            model.objective = self.product_sink_reaction_id
-            sol = loopless_solution(model)
+        original_objective = self.model.solver.objective
+        self.model.objective = self.product_sink_reaction_id
+        try:
+            sol = loopless_solution(self.model)
             return sol.fluxes[self.product_sink_reaction_id]
+        finally:
+            self.model.objective = original_objective
         
     def calc_maximal_biomass_growth(self):
         """
@@ -87,14 +205,17 @@ class FVSEOF():
         max_growth : float
             The maximal growth.
         """
-        with self.model as model:
-            model.objective = self.biomass_reaction_id
-            sol = loopless_solution(model)
+        original_objective = self.model.solver.objective
+        self.model.objective = self.biomass_reaction_id
+        try:
+            sol = loopless_solution(self.model)
             return sol.fluxes[self.biomass_reaction_id]
+        finally:
+            self.model.objective = original_objective
         
     def check_essential_reaction(self, reaction_id):
         """
-        Check if a reaction is essential.
+        Check if a reaction is essential. Only the attainable growth matters here, so plain FBA is used instead of a loopless solution.
         
         Parameters
         ---------- 
@@ -106,21 +227,100 @@ class FVSEOF():
         essential : bool
             Whether the reaction is essential or not.
         """
-        with self.model as model:
-            model.objective = self.biomass_reaction_id
-            reaction = model.reactions.get_by_id(reaction_id)
-            reaction.lower_bound = 0.0
-            reaction.upper_bound = 0.0
-            
-            try:
-                sol = loopless_solution(model)
-                if sol.fluxes[self.biomass_reaction_id] / self.maximal_biomass_growth < self.check_essential_reaction_threshold:
-                    return True
-                return False
-            except:
-                return True
+        original_objective = self.model.solver.objective
+        self.model.objective = self.biomass_reaction_id
+        try:
+            return self._check_essential_reaction(reaction_id)
+        finally:
+            self.model.objective = original_objective
+
+    def _check_essential_reaction(self, reaction_id):
+        """
+        Check if a reaction is essential, assuming the biomass reaction is already the objective of the model.
+        Only the bounds of the knocked out reaction are changed and restored, so this is cheap to call for many reactions in a row.
+
+        Parameters
+        ----------
+        reaction_id : str
+            The id of the reaction to check.
+
+        Returns
+        -------
+        essential : bool
+            Whether the reaction is essential or not.
+        """
+        reaction = self.model.reactions.get_by_id(reaction_id)
+        original_bounds = reaction.bounds
+        reaction.bounds = (0.0, 0.0)
+        try:
+            growth = self.model.slim_optimize()
+            status = self.model.solver.status
+        finally:
+            reaction.bounds = original_bounds
+
+        # An infeasible knockout cannot grow at all and hence counts as essential, at any threshold
+        if status != OPTIMAL:
+            return True
+        # Compare within solver tolerance, warm-started solves can end up marginally below the maximal growth
+        return growth < self.check_essential_reaction_threshold * self.maximal_biomass_growth - self.model.tolerance
+
+    def _calc_step_fluxes(self, step_lower_bound, reaction_ids, fva = True, fva_n_processes = 1):
+        """
+        Calculate the flux ranges for a single step, assuming the biomass reaction is already the objective of the model.
+        The lower bound on the product sink reaction is left at the step lower bound, it is up to the caller to restore it.
+
+        Parameters
+        ----------
+        step_lower_bound : float
+            The lower bound on target production for the step.
+        reaction_ids : list
+            The ids of the reactions to return fluxes for, in order.
+        fva : bool, optional
+            Whether to perform flux variability analysis. If False, a loopless FBA solution is used. Default is True.
+        fva_n_processes : int, optional
+            The number of processes to use for flux variability analysis. The default is 1.
+
+        Returns
+        -------
+        minimum : np.ndarray
+            The minimal flux of each reaction in reaction_ids. Equal to the maximum when FBA is used.
+        maximum : np.ndarray
+            The maximal flux of each reaction in reaction_ids. Equal to the minimum when FBA is used.
+        """
+        self.model.reactions.get_by_id(self.product_sink_reaction_id).lower_bound = step_lower_bound
+
+        if fva:
+            fva_df = flux_variability_analysis(self.model, fraction_of_optimum=_FVA_FRACTION_OF_OPTIMUM, processes=fva_n_processes).reindex(reaction_ids)
+            return fva_df["minimum"].to_numpy(dtype=np.float64), fva_df["maximum"].to_numpy(dtype=np.float64)
 
-    def run(self, n_steps = 10, check_essentiality=False, fva = True, fva_n_processes = 1) -> pd.DataFrame:
+        fba_sol = loopless_solution(self.model)
+        fba_fluxes = fba_sol.fluxes.reindex(reaction_ids).to_numpy(dtype=np.float64)
+        return fba_fluxes, fba_fluxes
+
+    def _precheck_non_essential_reactions(self, minimum, maximum, fraction_of_optimum):
+        """
+        Find reactions that are certainly not essential from flux ranges that were obtained while enforcing a fraction of the maximal growth, without the product constraint.
+        If the range of a reaction includes zero, there is a solution without flux through it that still reaches that fraction of the maximal growth, so knocking it out cannot push growth below the threshold.
+
+        Parameters
+        ----------
+        minimum : np.ndarray
+            The minimal flux of each reaction.
+        maximum : np.ndarray
+            The maximal flux of each reaction.
+        fraction_of_optimum : float
+            The fraction of the maximal growth that was enforced when obtaining the flux ranges.
+
+        Returns
+        -------
+        non_essential : np.ndarray
+            Boolean mask of the reactions that are certainly not essential. Reactions outside the mask still need a knockout check.
+        """
+        if self.check_essential_reaction_threshold > fraction_of_optimum:
+            return np.zeros(len(minimum), dtype=bool)
+        return (minimum <= self.model.tolerance) & (maximum >= -self.model.tolerance)
+
+    def run(self, n_steps = 10, check_essentiality=False, fva = True, fva_n_processes = 1, essentiality_n_processes = 1, step_n_processes = 1) -> pd.DataFrame:
         """
         Run FVSEOF on the model. 2 points for lower bound on target production are used to find fluxes that increase or decrease when the target production is increased.
         
@@ -134,6 +334,10 @@ class FVSEOF():
             Whether to perform flux variability analysis. If False, FBA is used, which turns this function into the FSEOF algorithm instead of the FVSEOF algorithm. Default is True.
         fva_n_processes : int, optional
             The number of processes to use for flux variability analysis. The default is 1.
+        essentiality_n_processes : int, optional
+            The number of processes to use for checking the essentiality of target reactions. The default is 1.
+        step_n_processes : int, optional
+            The number of processes to use for performing the steps in parallel. When larger than 1, flux variability analysis within each step runs in a single process and fva_n_processes is ignored. The default is 1.
             
         Returns
         -------
@@ -142,71 +346,87 @@ class FVSEOF():
         """
         steps_lower_bounds = [n/n_steps*self.product_max_theoretical_yield for n in range(0, n_steps)]
         method = "FVA" if fva else "FBA"
+        reaction_ids = self.model.reactions.list_attr("id")
+        reactions_by_id = {r.id: r for r in self.model.reactions}
 
         # Perform fva / fba and retain (mean) fluxes for each step
-        per_step_fluxes = {r_id: [] for r_id in [r.id for r in self.model.reactions]}
-        for i, step_lower_bound in enumerate(steps_lower_bounds):
-            print("\rPerforming {} for step {}/{}...".format(method, i+1, len(steps_lower_bounds)), end="")
-            with self.model as model:
-                model.objective = self.biomass_reaction_id
-                model.reactions.get_by_id(self.product_sink_reaction_id).lower_bound = step_lower_bound
-
-                if fva:
-                    fva_df = flux_variability_analysis(model, fraction_of_optimum=0.95, processes=fva_n_processes)
-                    for r_id in [r.id for r in self.model.reactions]:
-                        per_step_fluxes[r_id].append((fva_df.loc[r_id, "maximum"] + fva_df.loc[r_id, "minimum"]) / 2)
-                else:
-                    fba_sol = loopless_solution(model)
-                    for r_id in [r.id for r in self.model.reactions]:
-                        per_step_fluxes[r_id].append(fba_sol.fluxes[r_id])
+        fluxes = np.empty((len(reaction_ids), n_steps), dtype=np.float64, order="F")
+        step_n_processes = min(step_n_processes, n_steps)
+        if step_n_processes > 1:
+            with ProcessPool(step_n_processes, initializer=_init_worker, initargs=(self,)) as pool:
+                results = pool.imap_unordered(_step_fluxes_worker, [(i, step_lower_bound, fva) for i, step_lower_bound in enumerate(steps_lower_bounds)])
+                for done, (i, (minimum, maximum)) in enumerate(results):
+                    print("\rPerforming {} for step {}/{}...".format(method, done+1, len(steps_lower_bounds)), end="")
+                    fluxes[:, i] = (minimum + maximum) / 2
+                    if i == 0:
+                        first_step_minimum, first_step_maximum = minimum, maximum
+        else:
+            # The same solver problem is reused for every step, only the lower bound on the product sink
+            # changes in between, so the basis carries over.
+            product_sink_reaction = reactions_by_id[self.product_sink_reaction_id]
+            original_sink_lower_bound = product_sink_reaction.lower_bound
+            original_objective = self.model.solver.objective
+            self.model.objective = self.biomass_reaction_id
+            try:
+                for i, step_lower_bound in enumerate(steps_lower_bounds):
+                    print("\rPerforming {} for step {}/{}...".format(method, i+1, len(steps_lower_bounds)), end="")
+                    minimum, maximum = self._calc_step_fluxes(step_lower_bound, reaction_ids, fva=fva, fva_n_processes=fva_n_processes)
+                    fluxes[:, i] = (minimum + maximum) / 2
+                    if i == 0:
+                        first_step_minimum, first_step_maximum = minimum, maximum
+            finally:
+                product_sink_reaction.lower_bound = original_sink_lower_bound
+                self.model.objective = original_objective
         print("\nDone.")
 
-        # Assign target types based on min and max fluxes
-        target_types = {}
-        for r_id in [r.id for r in self.model.reactions]:
-            if not per_step_fluxes[r_id][0] == per_step_fluxes[r_id][-1]:
-                if per_step_fluxes[r_id][0] * per_step_fluxes[r_id][-1] >= 0:
-                    if abs(per_step_fluxes[r_id][-1]) > abs(per_step_fluxes[r_id][0]):
-                        target_types[r_id] = "Up"
-                    else:
-                        target_types[r_id] = "Down"
-                elif per_step_fluxes[r_id][0] * per_step_fluxes[r_id][-1] < 0:
-                    target_types[r_id] = "Reverse"
-
-        # Find slope of linear regressions
-        slopes = {}
-        for r_id in [r.id for r in self.model.reactions]:
-            slopes[r_id] = np.polyfit(steps_lower_bounds, per_step_fluxes[r_id], 1)[0]
-
-        # Find essentialities
-        essentialities = {}
+        # Assign target types based on min and max fluxes and find slopes of linear regressions
+        target_type_labels, slopes = _classify_and_slope(fluxes, steps_lower_bounds)
+        target_mask = target_type_labels != ""
+        target_reaction_ids = np.array(reaction_ids, dtype=object)[target_mask]
+
+        # Find essentialities. The first step does not constrain product formation, so its flux ranges already
+        # rule out part of the targets, only the remaining ones need a knockout.
+        essentialities = np.zeros(len(target_reaction_ids), dtype=bool)
         if check_essentiality:
             print("\nCalculating essentialities...")
-            for i, r_id in enumerate([r.id for r in self.model.reactions]):
-                print("\rChecking essentiality for reaction " + str(i+1) + "/" + str(len([r.id for r in self.model.reactions])) + "...", end="")
-                if r_id in target_types:
-                    essentialities[r_id] = self.check_essential_reaction(r_id) if check_essentiality else None
+            non_essential = self._precheck_non_essential_reactions(first_step_minimum[target_mask], first_step_maximum[target_mask], _FVA_FRACTION_OF_OPTIMUM if fva else 1.0)
+            knockout_positions = np.flatnonzero(~non_essential)
+            essentiality_n_processes = min(essentiality_n_processes, len(knockout_positions))
+            if essentiality_n_processes > 1:
+                chunk_size = len(knockout_positions) // essentiality_n_processes
+                with ProcessPool(essentiality_n_processes, initializer=_init_worker, initargs=(self,)) as pool:
+                    results = pool.imap_unordered(_check_essential_reaction_worker, [(position, target_reaction_ids[position]) for position in knockout_positions], chunksize=chunk_size)
+                    for i, (position, essential) in enumerate(results):
+                        print("\rChecking essentiality for reaction " + str(i+1) + "/" + str(len(knockout_positions)) + "...", end="")
+                        essentialities[position] = essential
+            else:
+                original_objective = self.model.solver.objective
+                self.model.objective = self.biomass_reaction_id
+                try:
+                    for i, position in enumerate(knockout_positions):
+                        print("\rChecking essentiality for reaction " + str(i+1) + "/" + str(len(knockout_positions)) + "...", end="")
+                        essentialities[position] = self._check_essential_reaction(target_reaction_ids[position])
+                finally:
+                    self.model.objective = original_objective
                     
-        # Combine into big df
-        df_data = {}
-        for r_id in [r.id for r in self.model.reactions]:
-            if r_id in target_types:
-                df_data[r_id] = {
-                    "target_type": target_types[r_id],
-                    "reaction":  self.model.reactions.get_by_id(r_id).name,
-                    "reaction formula": self.model.reactions.get_by_id(r_id).build_reaction_string(use_metabolite_names=True),
-                    "gene_reaction_rule": self.model.reactions.get_by_id(r_id).gene_reaction_rule.replace(" or ", "/").replace(" and ", "+"),
-                    "slope": slopes[r_id],
-                }
-
-                if check_essentiality:
-                    df_data[r_id]["essentiality"] = essentialities[r_id]
+        # Combine into big df, column by column
+        target_reactions = [reactions_by_id[r_id] for r_id in target_reaction_ids]
+        df_data = {
+            "target_type": target_type_labels[target_mask],
+            "reaction": [reaction.name for reaction in target_reactions],
+            "reaction formula": [reaction.build_reaction_string(use_metabolite_names=True) for reaction in target_reactions],
+            "gene_reaction_rule": [reaction.gene_reaction_rule.replace(" or ", "/").replace(" and ", "+") for reaction in target_reactions],
+            "slope": slopes[target_mask],
+        }
 
-                for i, step_lower_bound in enumerate(steps_lower_bounds):
-                    df_data[r_id]["step_" + str(i)] = per_step_fluxes[r_id][i]
-            
-        df = pd.DataFrame.from_dict(df_data, orient="index")
-        df.index.name = "reaction_id"
-        df = df.sort_values(by=['target_type', 'slope'], key=lambda x: x.abs() if x.name == 'slope' else x, ascending=[False, False])
+        if check_essentiality:
+            df_data["essentiality"] = essentialities
+
+        for i in range(n_steps):
+            df_data["step_" + str(i)] = fluxes[target_mask, i]
+
+        df = pd.DataFrame(df_data, index=pd.Index(target_reaction_ids, name="reaction_id"))
+        df["_abs_slope"] = np.abs(df["slope"])
+        df = df.sort_values(by=["target_type", "_abs_slope"], ascending=[False, False]).drop(columns="_abs_slope")
                        
         return df
\ No newline at end of file